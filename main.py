@@ -1,25 +1,31 @@
-import collections
+import asyncio
 import os
+import re
+from datetime import datetime, timezone
 
-import yaml
 from bson.objectid import ObjectId
-from fastapi import FastAPI
+from bson.regex import Regex
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic import BaseModel
-from pymongo import MongoClient
-
-# Connect to the MongoDB database
-db_client = MongoClient(
-    os.environ["MONGO_URI"]
-    if "MONGO_URI" in os.environ
-    else "mongodb://localhost:27017/"
-)
-db = db_client[os.environ["DB_NAME"] if "DB_NAME" in os.environ else "chaindb"]
-collection = db[
-    os.environ["COLLECTION_NAME"] if "COLLECTION_NAME" in os.environ else "chains"
-]
-
-app = FastAPI()
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
+DB_NAME = os.environ.get("DB_NAME", "chaindb")
+COLLECTION_NAME = os.environ.get("COLLECTION_NAME", "chains")
+MESSAGES_COLLECTION_NAME = os.environ.get("MESSAGES_COLLECTION_NAME", "messages")
+# "regex" assigns chains whose condition starts with the requested one,
+# "equality" only assigns chains whose condition is exactly the requested one,
+# "prefix" assigns chains whose condition, up to the separator, is the requested one
+CONDITION_MODE = os.environ.get("CONDITION_MODE", "regex")
+if CONDITION_MODE not in ("regex", "equality", "prefix"):
+    raise ValueError(f"unknown CONDITION_MODE {CONDITION_MODE!r}")
+CONDITION_PREFIX_SEPARATOR = os.environ.get("CONDITION_PREFIX_SEPARATOR", ":")
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,117 +36,296 @@ app.add_middleware(
 )
 
 
-async def sample_chain_to_write(condition: str):
+@app.on_event("startup")
+async def connect_to_database():
+    """
+    Connect to the MongoDB database once the worker has started, so every worker process gets its own pool.
+    Then ping it so the pool is opened before the first request comes in.
+    """
+    app.state.db_client = AsyncIOMotorClient(
+        MONGO_URI,
+        maxPoolSize=50,
+        minPoolSize=10,
+        connectTimeoutMS=2000,
+        serverSelectionTimeoutMS=3000,
+    )
+    db = app.state.db_client[DB_NAME]
+    app.state.collection = db[COLLECTION_NAME]
+    app.state.messages_collection = db[MESSAGES_COLLECTION_NAME]
+
+    await db.command("ping")
+
+
+@app.on_event("shutdown")
+async def close_database_connection():
+    """
+    Close this worker's connection pool.
+    """
+    app.state.db_client.close()
+
+
+@app.on_event("startup")
+async def create_indexes():
+    """
+    Make sure the indexes backing the assign queries exist, so picking the least-used chain is an index scan.
+    """
+    collection = app.state.collection
+    messages_collection = app.state.messages_collection
+
+    # only idle chains are ever assigned, so busy ones are left out of the index, and
+    # every field the sample queries filter on or return is a key, so they're covered
+    condition_field = "condition_prefix" if CONDITION_MODE == "prefix" else "condition"
+    await collection.create_index(
+        [(condition_field, 1), ("busy", 1), ("writes", 1), ("reads", 1), ("_id", 1)],
+        partialFilterExpression={"busy": False},
+        name=f"idle_{condition_field}_busy_writes_reads_id",
+    )
+    await messages_collection.create_index(
+        [("chain_id", 1), ("seq", 1)], unique=True, name="chain_seq"
+    )
+
+
+def get_collection(request: Request):
+    """
+    Get the chains collection of the worker handling the request.
+    """
+    return request.app.state.collection
+
+
+def get_messages_collection(request: Request):
+    """
+    Get the messages collection of the worker handling the request.
+    """
+    return request.app.state.messages_collection
+
+
+async def sample_least_used(collection, match: dict):
     """
-    Find a chain that begins with the "condition" string, isn't busy, and has the smallest number of writes and reads.
+    Pick a chain matching the filter uniformly at random among those tied for the smallest number of writes and reads.
+    The random pick happens on the server, so only a single chain's _id, writes, and reads are sent back.
     """
+    projection = {"_id": 1, "writes": 1, "reads": 1}
+    fewest = await collection.find_one(
+        match, projection=projection, sort=[("writes", 1), ("reads", 1)]
+    )
+    if fewest is None:
+        return None
+
     pipeline = [
-        {"$match": {"condition": {"$regex": f"^{condition}"}, "busy": False}},
-        {
-            "$group": {
-                "_id": {"reads": "$reads", "writes": "$writes"},
-                "chains": {"$push": "$$ROOT"},
-            }
-        },
-        {"$sort": {"_id.writes": 1, "_id.reads": 1}},
-        {"$limit": 1},
-        {"$unwind": "$chains"},
-        {"$replaceRoot": {"newRoot": "$chains"}},
+        {"$match": {**match, "writes": fewest["writes"], "reads": fewest["reads"]}},
+        {"$project": projection},
         {"$sample": {"size": 1}},
     ]
+    sampled = await collection.aggregate(pipeline).to_list(None)
+    # the tied chains may all have been claimed in between, fall back to the one we saw
+    return sampled[0] if sampled else fewest
+
 
-    chains = list(collection.aggregate(pipeline))[0]
-    return chains
+# how many sampled chains to try claiming before claiming any least-used one
+MAX_CLAIM_ATTEMPTS = 3
 
 
-async def sample_chain_to_read(condition: str):
+def get_condition_prefix(condition):
     """
-    Find a chain that begins with the "condition" string, isn't busy, and has the smallest number of writes and reads.
+    Get the part of a condition before CONDITION_PREFIX_SEPARATOR, which "prefix" mode matches on.
+    """
+    if isinstance(condition, str):
+        return condition.split(CONDITION_PREFIX_SEPARATOR, 1)[0]
+
+    return condition
+
+
+def condition_filter(condition: str):
+    """
+    Build the filter matching chains for the condition in the configured CONDITION_MODE.
+    """
+    if CONDITION_MODE == "prefix":
+        return {"condition_prefix": condition}
+
+    if CONDITION_MODE == "equality":
+        return {"condition": condition}
+
+    return {"condition": Regex(f"^{re.escape(condition)}")}
+
+
+async def sample_chain_to_write(collection, condition: str):
+    """
+    Find a chain that matches the "condition" string, isn't busy, and has the smallest number of writes and reads.
+    """
+    return await sample_least_used(
+        collection, {**condition_filter(condition), "busy": False}
+    )
+
+
+async def sample_chain_to_read(collection, condition: str):
+    """
+    Find a chain that matches the "condition" string, isn't busy, and has the smallest number of writes and reads.
     Plus make sure it has at least one write.
     """
-    pipeline = [
-        {
-            "$match": {
-                "condition": {"$regex": f"^{condition}"},
-                "busy": False,
-                "writes": {"$gt": 0},
-            }
-        },
-        {
-            "$group": {
-                "_id": {"reads": "$reads", "writes": "$writes"},
-                "chains": {"$push": "$$ROOT"},
-            }
-        },
-        {"$sort": {"_id.writes": 1, "_id.reads": 1}},
-        {"$limit": 1},
-        {"$unwind": "$chains"},
-        {"$replaceRoot": {"newRoot": "$chains"}},
-        {"$sample": {"size": 1}},
-    ]
+    return await sample_least_used(
+        collection,
+        {**condition_filter(condition), "busy": False, "writes": {"$gt": 0}},
+    )
 
-    chains = list(collection.aggregate(pipeline))[0]
-    return chains
+
+def parse_chain_id(chain_id: str) -> ObjectId:
+    """
+    Turn the chain_id path parameter into an ObjectId, rejecting malformed ids before they reach the database.
+    """
+    if not ObjectId.is_valid(chain_id):
+        raise HTTPException(status_code=400, detail="invalid chain id")
+
+    return ObjectId(chain_id)
+
+
+async def load_messages(messages_collection, chain: dict):
+    """
+    Attach the chain's messages, which live in their own collection, to the chain.
+    Chains created before messages were split out keep their earlier messages embedded, so those come first.
+    """
+    cursor = messages_collection.find(
+        {"chain_id": chain["_id"]}, projection={"message": 1}, sort=[("seq", 1)]
+    )
+    chain["messages"] = chain.get("messages", []) + [
+        doc["message"] async for doc in cursor
+    ]
+    return chain
 
 
 @app.get("/assign/{condition}")
-async def assign_to_chain(condition: str):
+async def assign_to_chain(
+    condition: str,
+    collection=Depends(get_collection),
+    messages_collection=Depends(get_messages_collection),
+):
     """
     Find the chain for the given condition that isn't in use and has the smallest number of completions.
     Mark that chain as in use, then return it.
     """
-    chain = await sample_chain_to_write(condition)
-    if chain is None:
-        return 404
-
-    chain["busy"] = True
-    collection.update_one({"_id": chain["_id"]}, {"$set": chain})
-
+    for _ in range(MAX_CLAIM_ATTEMPTS):
+        candidate = await sample_chain_to_write(collection, condition)
+        if candidate is None:
+            raise HTTPException(status_code=404, detail="no chain available")
+
+        # only claim the chain if nobody else took it since it was sampled
+        chain = await collection.find_one_and_update(
+            {"_id": candidate["_id"], "busy": False},
+            {"$set": {"busy": True}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if chain is not None:
+            break
+    else:
+        # under heavy contention, give up on the random tie-break and claim atomically
+        chain = await collection.find_one_and_update(
+            {**condition_filter(condition), "busy": False},
+            {"$set": {"busy": True}},
+            sort=[("writes", 1), ("reads", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if chain is None:
+            raise HTTPException(status_code=404, detail="no chain available")
+
+    await load_messages(messages_collection, chain)
     chain["_id"] = str(chain["_id"])
-    return chain
+    return ORJSONResponse(chain)
 
 
 @app.get("/assign/no-busy/{condition}")
-async def assign_to_chain_no_busy(condition: str):
+async def assign_to_chain_no_busy(
+    condition: str,
+    collection=Depends(get_collection),
+    messages_collection=Depends(get_messages_collection),
+):
     """
     Find the chain for the given condition that isn't in use and has the smallest number of completions.
     Then return that chain without marking it busy.
     """
-    chain = await sample_chain_to_read(condition)
+    candidate = await sample_chain_to_read(collection, condition)
+    if candidate is None:
+        raise HTTPException(status_code=404, detail="no chain available")
+
+    chain = await collection.find_one({"_id": candidate["_id"]})
     if chain is None:
-        return 404
+        raise HTTPException(status_code=404, detail="chain not found")
 
+    await load_messages(messages_collection, chain)
     chain["_id"] = str(chain["_id"])
-    return chain
+    return ORJSONResponse(chain)
+
+
+def chain_etag(chain: dict) -> str:
+    """
+    Build an ETag for a chain from the fields that change when it does.
+    A completion keeps the chain busy until its message is stored and only then frees it,
+    so the tag always changes once the new message is visible.
+    """
+    return f'"{chain["writes"]}-{chain["reads"]}-{int(chain["busy"])}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Check an If-None-Match header against an ETag, using weak comparison as RFC 9110 requires.
+    """
+    if if_none_match.strip() == "*":
+        return True
+
+    return any(
+        tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
+    )
 
 
 @app.get("/chain/{chain_id}")
-async def get_chain_by_id(chain_id: str):
+async def get_chain_by_id(
+    request: Request,
+    chain_id: ObjectId = Depends(parse_chain_id),
+    collection=Depends(get_collection),
+    messages_collection=Depends(get_messages_collection),
+):
     """
     Get the chain with the given chain_id.
+    If the client already has the current version, answer 304 after only looking at the counters.
+    The response is built directly so FastAPI doesn't walk the messages with jsonable_encoder first.
     """
-    chain_id = ObjectId(chain_id)
-    chain = collection.find_one({"_id": chain_id})
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        counters = await collection.find_one(
+            {"_id": chain_id}, projection={"writes": 1, "reads": 1, "busy": 1}
+        )
+        if counters is None:
+            raise HTTPException(status_code=404, detail="chain not found")
+
+        etag = chain_etag(counters)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+    chain = await collection.find_one({"_id": chain_id})
     if chain is None:
-        return 404
+        raise HTTPException(status_code=404, detail="chain not found")
 
+    await load_messages(messages_collection, chain)
     chain["_id"] = str(chain["_id"])
-    return chain
+    return ORJSONResponse(chain, headers={"ETag": chain_etag(chain)})
 
 
 @app.post("/free/{chain_id}")
-async def free_chain(chain_id: str):
+async def free_chain(
+    chain_id: ObjectId = Depends(parse_chain_id), collection=Depends(get_collection)
+):
     """
     Set the specified chain to no be busy anymore (without adding any data).
     """
-    chain_id = ObjectId(chain_id)
-    chain = collection.find_one({"_id": chain_id})
+    chain = await collection.find_one_and_update(
+        {"_id": chain_id},
+        {"$set": {"busy": False}},
+        return_document=ReturnDocument.AFTER,
+        projection={"messages": 0},
+    )
     if chain is None:
-        return 404
-
-    res = collection.update_one({"_id": chain_id}, {"$set": {"busy": False}})
+        raise HTTPException(status_code=404, detail="chain not found")
 
-    return res.raw_result
+    chain["_id"] = str(chain["_id"])
+    return chain
 
 
 class MessageBody(BaseModel):
@@ -148,50 +333,132 @@ class MessageBody(BaseModel):
 
 
 @app.post("/chain/complete/{chain_id}")
-async def add_message_to_chain(chain_id: str, body: MessageBody):
+async def add_message_to_chain(
+    body: MessageBody,
+    chain_id: ObjectId = Depends(parse_chain_id),
+    collection=Depends(get_collection),
+    messages_collection=Depends(get_messages_collection),
+):
     """
     Add a message to the chain with the given chain_id, then mark the chain as no longer in use.
     """
-    chain_id = ObjectId(chain_id)
-    chain = collection.find_one({"_id": chain_id})
+    # the chain stays busy until its message is stored, so nobody is assigned it first
+    chain = await collection.find_one(
+        {"_id": chain_id, "busy": True}, projection={"writes": 1}
+    )
 
     if chain is None:
-        return "chain not found"
+        # only look up which case it was on the failure path
+        if await collection.count_documents({"_id": chain_id}, limit=1) == 0:
+            raise HTTPException(status_code=404, detail="chain not found")
+        raise HTTPException(status_code=409, detail="chain not in use")
+
+    # the unique (chain_id, seq) index lets one completion store this write's message
+    seq = chain["writes"] + 1
+    try:
+        await messages_collection.insert_one(
+            {
+                "chain_id": chain_id,
+                "seq": seq,
+                "message": body.message,
+                "created_at": datetime.now(timezone.utc),
+            }
+        )
+    except DuplicateKeyError:
+        stored = False
+    else:
+        stored = True
+
+    # freeing is tied to this write, so it happens once however many completions get
+    # here, and a duplicate still finishes a completion interrupted before this step
+    chain = await collection.find_one_and_update(
+        {"_id": chain_id, "busy": True, "writes": seq - 1},
+        {"$inc": {"writes": 1, "reads": 1}, "$set": {"busy": False}},
+        return_document=ReturnDocument.AFTER,
+        projection={"messages": 0},
+    )
+    if not stored:
+        raise HTTPException(status_code=409, detail="chain not in use")
 
-    if not chain["busy"]:
-        return "chain not in use"
+    if chain is None:
+        # a duplicate completion freed the chain for this message in the meantime
+        chain = await collection.find_one({"_id": chain_id}, projection={"messages": 0})
+        if chain is None:
+            raise HTTPException(status_code=404, detail="chain not found")
 
-    message = body.message
-    chain["messages"].append(message)
-    chain["busy"] = False
-    chain["writes"] += 1
-    chain["reads"] += 1
-    res = collection.update_one({"_id": chain_id}, {"$set": chain})
+    chain["_id"] = str(chain["_id"])
+    return chain
 
-    return res.raw_result
+
+@app.get("/chain/{chain_id}/messages")
+async def get_chain_messages(
+    chain_id: ObjectId = Depends(parse_chain_id),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    collection=Depends(get_collection),
+    messages_collection=Depends(get_messages_collection),
+):
+    """
+    Get a page of the messages of the chain with the given chain_id, oldest first.
+    Pages run over the same list as the chain's "messages", so embedded messages of older chains come first.
+    """
+    chain = await collection.find_one(
+        {"_id": chain_id},
+        projection={
+            "messages": {"$slice": [skip, limit]},
+            "n_embedded": {"$size": {"$ifNull": ["$messages", []]}},
+        },
+    )
+    if chain is None:
+        raise HTTPException(status_code=404, detail="chain not found")
+
+    messages = chain.get("messages", [])
+    if len(messages) < limit:
+        cursor = messages_collection.find(
+            {"chain_id": chain_id},
+            projection={"message": 1},
+            sort=[("seq", 1)],
+            skip=max(0, skip - chain["n_embedded"]),
+            limit=limit - len(messages),
+        )
+        messages += [doc["message"] async for doc in cursor]
+
+    return messages
 
 
 @app.post("/chain/read/{chain_id}")
-async def update_chain_read_count(chain_id: str):
+async def update_chain_read_count(
+    chain_id: ObjectId = Depends(parse_chain_id), collection=Depends(get_collection)
+):
     """
     Add a message to the chain with the given chain_id, then mark the chain as no longer in use.
     """
-    chain_id = ObjectId(chain_id)
-    chain = collection.find_one({"_id": chain_id})
-
-    chain["reads"] += 1
-    res = collection.update_one({"_id": chain_id}, {"$set": chain})
+    chain = await collection.find_one_and_update(
+        {"_id": chain_id},
+        {"$inc": {"reads": 1}},
+        return_document=ReturnDocument.AFTER,
+        projection={"messages": 0},
+    )
+    if chain is None:
+        raise HTTPException(status_code=404, detail="chain not found")
 
-    return res.raw_result
+    chain["_id"] = str(chain["_id"])
+    return chain
 
 
 @app.delete("/demolish")
-async def delete_all_chains():
+async def delete_all_chains(
+    collection=Depends(get_collection),
+    messages_collection=Depends(get_messages_collection),
+):
     """
-    Delete all chains.
+    Delete all chains and their messages.
     """
-    res = collection.delete_many({})
-    return res.raw_result
+    # the two collections are independent, so clear them concurrently
+    res, _ = await asyncio.gather(
+        collection.delete_many({}), messages_collection.delete_many({})
+    )
+    return {"deleted_count": res.deleted_count, "acknowledged": res.acknowledged}
 
 
 class SetupBody(BaseModel):
@@ -200,24 +467,24 @@ class SetupBody(BaseModel):
 
 
 @app.post("/setup")
-async def set_up_chains(body: SetupBody):
+async def set_up_chains(body: SetupBody, collection=Depends(get_collection)):
     """
     Create all the chains.
     """
-    to_insert = []
-    for condition in body.conditions:
-        for _ in range(body.n_chains_per_condition):
-            to_insert.append(
-                {
-                    "condition": condition,
-                    "messages": [],
-                    "busy": False,
-                    "writes": 0,
-                    "reads": 0,
-                }
-            )
-
-    res = collection.insert_many(to_insert)
+    to_insert = [
+        {
+            "condition": condition,
+            "condition_prefix": get_condition_prefix(condition),
+            "busy": False,
+            "writes": 0,
+            "reads": 0,
+        }
+        for condition in body.conditions
+        for _ in range(body.n_chains_per_condition)
+    ]
+
+    # the driver splits this into batches the server accepts, no manual chunking needed
+    res = await collection.insert_many(to_insert, ordered=False)
 
     return {
         "inserted_ids": [str(oid) for oid in res.inserted_ids],